@@ -3,18 +3,130 @@ from flask_cors import CORS
 import cv2
 import numpy as np
 import face_recognition
+import dlib
 import os
 import sqlite3
 from datetime import datetime, date
 import json
+import hashlib
+import threading
+import uuid
+from collections import OrderedDict
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+try:
+    from sklearn.cluster import KMeans
+except ImportError:
+    KMeans = None
 
 app = Flask(__name__)
 CORS(app)
 
+# face_recognition encodings are 128-d; 0.6 is the library's default match tolerance
+ENCODING_SIZE = 128
+MATCH_TOLERANCE = 0.6
+# Matches are thresholded on squared distance to skip the sqrt
+MATCH_DISTANCE_SQ = MATCH_TOLERANCE ** 2
+# Frames whose longest side exceeds this are shrunk before face detection;
+# faces are still encoded from the full-resolution frame
+DETECTION_MAX_SIDE = 1600
+# Without CUDA, HOG upsamples frames this small twice instead of once so small
+# faces are still found
+HOG_SMALL_FRAME_SIDE = 640
+# Rosters at least this large are k-means clustered (k ~ sqrt(N)) and each
+# probe is only compared with the members of its CLUSTER_PROBES nearest clusters
+CLUSTER_MIN_FACES = 1000
+CLUSTER_PROBES = 2
+# Reloads reuse the fitted centroids until the roster has changed size by this
+# factor since the last fit; the seed keeps fits reproducible across restarts
+CLUSTER_REFIT_FACTOR = 1.25
+CLUSTER_RANDOM_STATE = 0
+# Recognition results kept for re-submitted images, keyed by content hash
+RECOGNITION_CACHE_SIZE = 256
+
+if njit is not None:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def sq_dists_q(probe_q, known_q_T, out):
+        """Squared distances, in quantized units, from one int8 probe to every column of known_q_T"""
+        n_dims, n_known = known_q_T.shape
+        for j in prange(n_known):
+            s = 0
+            for d in range(n_dims):
+                # Widen before subtracting; 128 * 254^2 still fits in int32
+                diff = np.int32(probe_q[d]) - np.int32(known_q_T[d, j])
+                s += diff * diff
+            out[j] = s
+else:
+    sq_dists_q = None
+
+def decode_image(image_bytes):
+    """Decode an encoded image to an RGB array, or None if it is not an image"""
+    # imdecode asserts on an empty buffer, e.g. a form part with no file chosen
+    if not image_bytes:
+        return None
+    image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        return None
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+def content_key(images_bytes):
+    """Hash identifying a set of uploaded images, used for job and result deduplication"""
+    return b''.join(
+        hashlib.blake2b(image_bytes, digest_size=16).digest() for image_bytes in images_bytes
+    )
+
+def decode_upload(image_bytes):
+    """decode_image for an upload that must be an image; raises ValueError otherwise"""
+    image = decode_image(image_bytes)
+    if image is None:
+        raise ValueError("Could not decode the image")
+    return image
+
+def shrink_for_detection(image):
+    """Copy of image with its longest side capped at DETECTION_MAX_SIDE, and the scale used
+    
+    Detection cost grows with pixel count, so only large frames are shrunk.
+    """
+    scale = min(1.0, DETECTION_MAX_SIDE / max(image.shape[:2]))
+    if scale == 1.0:
+        return image, scale
+    return cv2.resize(image, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_AREA), scale
+
+def scale_face_locations(face_locations, scale, image_shape):
+    """Map (top, right, bottom, left) boxes found on a resized copy back onto the original image"""
+    height, width = image_shape[:2]
+    return [
+        (
+            max(0, int(round(top / scale))),
+            min(width, int(round(right / scale))),
+            min(height, int(round(bottom / scale))),
+            max(0, int(round(left / scale))),
+        )
+        for top, right, bottom, left in face_locations
+    ]
+
 # Database setup
+def _connect():
+    """Open the attendance database with WAL and tuned pragmas"""
+    conn = sqlite3.connect('attendance.db', check_same_thread=False)
+    # WAL lets the read endpoints run while attendance is being written
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-8000")
+    conn.execute("PRAGMA mmap_size=268435456")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
 def init_db():
-    conn = sqlite3.connect('attendance.db')
-    cursor = conn.cursor()
+    cursor = DB.cursor()
     
     # Students table
     cursor.execute('''
@@ -22,11 +134,23 @@ def init_db():
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             student_id TEXT UNIQUE,
             name TEXT NOT NULL,
-            face_encoding TEXT,
+            face_encoding BLOB,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
     ''')
     
+    # Convert encodings stored as JSON text by older versions to float32 bytes
+    cursor.execute(
+        "SELECT student_id, face_encoding FROM students WHERE typeof(face_encoding) = 'text'"
+    )
+    legacy_rows = cursor.fetchall()
+    for student_id, encoding_json in legacy_rows:
+        encoding = np.array(json.loads(encoding_json), dtype=np.float32)
+        cursor.execute(
+            "UPDATE students SET face_encoding = ? WHERE student_id = ?",
+            (sqlite3.Binary(encoding.tobytes()), student_id)
+        )
+    
     # Attendance table
     cursor.execute('''
         CREATE TABLE IF NOT EXISTS attendance (
@@ -39,36 +163,200 @@ def init_db():
         )
     ''')
     
-    conn.commit()
-    conn.close()
+    # One row per student per day, so INSERT OR REPLACE overwrites instead of
+    # appending. Databases created before the index may hold duplicates, which
+    # must go before it can be built; once it exists this is skipped.
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'ux_attendance'")
+    if cursor.fetchone() is None:
+        cursor.execute('''
+            DELETE FROM attendance WHERE id NOT IN (
+                SELECT MAX(id) FROM attendance GROUP BY student_id, date
+            )
+        ''')
+        cursor.execute(
+            "CREATE UNIQUE INDEX ux_attendance ON attendance (student_id, date)"
+        )
+    # For date-only scans of the attendance history
+    cursor.execute("CREATE INDEX IF NOT EXISTS ix_attendance_date ON attendance (date)")
+    
+    DB.commit()
+
+# One connection shared by every thread for writes, opened and tuned once.
+# DB_LOCK keeps statements from different threads out of each other's
+# transactions.
+DB = _connect()
+DB_LOCK = threading.Lock()
+init_db()
+
+# Read-only routes use a connection per thread instead, without DB_LOCK, so
+# under WAL they never wait behind an attendance write
+_read_connections = threading.local()
+
+def _read_connection():
+    """This thread's read-only connection, opened on first use"""
+    conn = getattr(_read_connections, 'conn', None)
+    if conn is None:
+        conn = _connect()
+        _read_connections.conn = conn
+    return conn
+
+class KnownFaces:
+    """Immutable snapshot of the roster and its matching tables
+    
+    load_known_faces builds a new snapshot and swaps it in with one assignment,
+    so a recognition running meanwhile sees either the old roster or the new
+    one, never a mix.
+    """
+    
+    def __init__(self, students, previous=None):
+        self.names = {student_id: name for student_id, name, _ in students}
+        self.all_ids = list(self.names)
+        
+        encodings = []
+        self.face_ids = []
+        for student_id, name, encoding_blob in students:
+            if encoding_blob:
+                encodings.append(np.frombuffer(encoding_blob, dtype=np.float32))
+                self.face_ids.append(student_id)
+        
+        # One contiguous (N, 128) matrix so matching is a single vectorized kernel
+        if encodings:
+            self.matrix = np.ascontiguousarray(np.stack(encodings), dtype=np.float32)
+        else:
+            self.matrix = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        # Dimension-major (128, N) copy used as the right-hand side of the matmul
+        self.matrix_T = np.ascontiguousarray(self.matrix.T)
+        # |k|^2 is the same for every query, so compute it once here
+        self.sqnorms = np.einsum('ij,ij->i', self.matrix, self.matrix).astype(np.float32)
+        # Symmetric int8 copy of the table, a quarter of the bytes, for the Numba kernel
+        max_abs = float(np.abs(self.matrix).max()) if len(self.matrix) else 0.0
+        self.quant_scale = 127.0 / max_abs if max_abs > 0 else 1.0
+        self.q_T = self._quantize(self.matrix_T)
+        
+        # Cluster large rosters so each probe only scans a few clusters
+        self.kmeans = None
+        self.n_fitted = 0
+        self.cluster_ids = np.empty(0, dtype=np.intp)
+        self.faces_by_cluster = []
+        n_known = len(self.face_ids)
+        if KMeans is not None and n_known >= CLUSTER_MIN_FACES:
+            if (previous is not None and previous.kmeans is not None
+                    and previous.n_fitted / CLUSTER_REFIT_FACTOR <= n_known <= previous.n_fitted * CLUSTER_REFIT_FACTOR):
+                # Small roster change: assign every face to the existing centroids
+                self.kmeans = previous.kmeans
+                self.n_fitted = previous.n_fitted
+                labels = self.kmeans.predict(self.matrix)
+            else:
+                n_clusters = max(1, int(np.sqrt(n_known)))
+                self.kmeans = KMeans(
+                    n_clusters=n_clusters, n_init=4, random_state=CLUSTER_RANDOM_STATE
+                ).fit(self.matrix)
+                self.n_fitted = n_known
+                labels = self.kmeans.labels_
+            faces_by_label = [np.where(labels == c)[0] for c in range(self.kmeans.n_clusters)]
+            # Reassigning faces to reused centroids can empty a cluster; only the
+            # non-empty ones are ever probed
+            self.cluster_ids = np.array(
+                [c for c, members in enumerate(faces_by_label) if len(members)], dtype=np.intp
+            )
+            self.faces_by_cluster = [faces_by_label[c] for c in self.cluster_ids]
+    
+    def _quantize(self, values):
+        """Symmetric int8 quantization with the known-face table's scale"""
+        return np.clip(np.round(values * self.quant_scale), -127, 127).astype(np.int8)
+    
+    def face_distances_sq(self, probes, candidates=None):
+        """Squared Euclidean distances from each probe to the known faces, shape (M, N)
+        
+        If candidates is given, only those known-face indices are compared and the
+        columns follow their order. With Numba the distances come from the int8
+        table and are approximate; use them for ranking only.
+        """
+        if sq_dists_q is not None:
+            # Per-worker SIMD kernel over the int8 (128, N) table; a quarter of the
+            # float32 memory traffic and no contention for the shared BLAS thread pool
+            q_T = self.q_T if candidates is None else self.q_T[:, candidates]
+            distances_sq = np.empty((len(probes), q_T.shape[1]), dtype=np.int32)
+            for i, probe_q in enumerate(self._quantize(probes)):
+                sq_dists_q(probe_q, q_T, distances_sq[i])
+            return distances_sq.astype(np.float32) / np.float32(self.quant_scale ** 2)
+        
+        known_T = self.matrix_T
+        known_sqnorms = self.sqnorms
+        if candidates is not None:
+            known_T = known_T[:, candidates]
+            known_sqnorms = known_sqnorms[candidates]
+        
+        # |p - k|^2 = |p|^2 + |k|^2 - 2 p.k, with all dot products in one matmul
+        probe_sqnorms = np.einsum('ij,ij->i', probes, probes)
+        distances_sq = probe_sqnorms[:, None] + known_sqnorms[None, :] - 2.0 * (probes @ known_T)
+        # Rounding can push near-identical pairs slightly below zero
+        return np.maximum(distances_sq, 0.0)
+    
+    def match_faces(self, probes):
+        """Index of and squared distance to the closest known face for each probe"""
+        if self.kmeans is None:
+            best_match_indices = self.face_distances_sq(probes).argmin(axis=1)
+        else:
+            # Large roster: only scan the members of the clusters nearest each probe
+            n_probe_clusters = min(CLUSTER_PROBES, len(self.faces_by_cluster))
+            centroid_distances = self.kmeans.transform(probes)[:, self.cluster_ids]
+            nearest_clusters = np.argsort(centroid_distances, axis=1)[:, :n_probe_clusters]
+            
+            best_match_indices = np.empty(len(probes), dtype=np.intp)
+            for i, clusters in enumerate(nearest_clusters):
+                candidates = np.concatenate([self.faces_by_cluster[c] for c in clusters])
+                distances_sq = self.face_distances_sq(probes[i:i + 1], candidates)[0]
+                best_match_indices[i] = candidates[distances_sq.argmin()]
+        
+        # Ranking may have used the int8 table; score only the winners exactly
+        diff = probes - self.matrix[best_match_indices]
+        return best_match_indices, np.einsum('ij,ij->i', diff, diff)
 
 class AttendanceSystem:
     def __init__(self):
-        self.known_face_encodings = []
-        self.known_face_ids = []
+        self.known = KnownFaces([])
+        self.recognition_cache = OrderedDict()
+        self.recognition_cache_lock = threading.Lock()
+        self.known_faces_version = 0
+        self.roster_signature = None
+        # Serializes reloads so each snapshot builds on the latest one
+        self.reload_lock = threading.Lock()
         self.load_known_faces()
     
     def load_known_faces(self):
         """Load known face encodings from database"""
-        conn = sqlite3.connect('attendance.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT student_id, name, face_encoding FROM students")
-        students = cursor.fetchall()
-        conn.close()
-        
-        self.known_face_encodings = []
-        self.known_face_ids = []
-        
-        for student_id, name, encoding_json in students:
-            if encoding_json:
-                encoding = json.loads(encoding_json)
-                self.known_face_encodings.append(np.array(encoding))
-                self.known_face_ids.append(student_id)
+        with self.reload_lock:
+            with DB_LOCK:
+                students = DB.execute("SELECT student_id, name, face_encoding FROM students").fetchall()
+                roster_signature = self._roster_signature()
+            known = KnownFaces(students, previous=self.known)
+            
+            # Publish the finished snapshot, then retire results cached against the old one
+            with self.recognition_cache_lock:
+                self.known = known
+                self.roster_signature = roster_signature
+                self.recognition_cache.clear()
+                self.known_faces_version += 1
+    
+    def _roster_signature(self):
+        """Cheap marker that changes whenever a student is registered; call with DB_LOCK held"""
+        # INSERT OR REPLACE gives a re-registered student a new AUTOINCREMENT id
+        return DB.execute("SELECT MAX(id), COUNT(*) FROM students").fetchone()
     
-    def register_student(self, student_id, name, image_file):
+    def reload_if_roster_changed(self):
+        """Reload known faces if another process has registered students since the last load"""
+        with DB_LOCK:
+            roster_signature = self._roster_signature()
+        if roster_signature != self.roster_signature:
+            self.load_known_faces()
+    
+    def register_student(self, student_id, name, image_bytes):
         """Register a new student with face encoding"""
         # Load image and find face
-        image = face_recognition.load_image_file(image_file)
+        image = decode_image(image_bytes)
+        if image is None:
+            return False, "Could not decode the image"
         face_encodings = face_recognition.face_encodings(image)
         
         if len(face_encodings) == 0:
@@ -76,91 +364,199 @@ class AttendanceSystem:
         
         # Store face encoding
         face_encoding = face_encodings[0]
-        encoding_json = json.dumps(face_encoding.tolist())
+        encoding_blob = sqlite3.Binary(face_encoding.astype(np.float32).tobytes())
         
         # Save to database
-        conn = sqlite3.connect('attendance.db')
-        cursor = conn.cursor()
         try:
-            cursor.execute(
-                "INSERT OR REPLACE INTO students (student_id, name, face_encoding) VALUES (?, ?, ?)",
-                (student_id, name, encoding_json)
-            )
-            conn.commit()
-            conn.close()
+            with DB_LOCK, DB:
+                DB.execute(
+                    "INSERT OR REPLACE INTO students (student_id, name, face_encoding) VALUES (?, ?, ?)",
+                    (student_id, name, encoding_blob)
+                )
             
             # Reload known faces
             self.load_known_faces()
             return True, "Student registered successfully"
         except Exception as e:
-            conn.close()
             return False, f"Error: {str(e)}"
     
-    def mark_attendance(self, image_file, is_live_feed=False):
-        """Mark attendance from image or live feed"""
-        if is_live_feed:
-            # For live feed, image_file is numpy array
-            image = image_file
-        else:
-            image = face_recognition.load_image_file(image_file)
+    def _detect_faces(self, images):
+        """Find face locations in each image, batching on the GPU when dlib has CUDA"""
+        if not dlib.DLIB_USE_CUDA:
+            return [
+                face_recognition.face_locations(
+                    image,
+                    number_of_times_to_upsample=2 if max(image.shape[:2]) <= HOG_SMALL_FRAME_SIDE else 1,
+                    model='hog'
+                )
+                for image in images
+            ]
         
-        # Find faces in the image
-        face_locations = face_recognition.face_locations(image)
-        face_encodings = face_recognition.face_encodings(image, face_locations)
+        # dlib's CNN batch detector needs every image in a batch to share one shape
+        images_by_shape = {}
+        for i, image in enumerate(images):
+            images_by_shape.setdefault(image.shape, []).append(i)
         
-        present_students = []
+        face_locations = [None] * len(images)
+        for indices in images_by_shape.values():
+            batch_locations = face_recognition.batch_face_locations(
+                [images[i] for i in indices], number_of_times_to_upsample=1, batch_size=128
+            )
+            for i, locations in zip(indices, batch_locations):
+                face_locations[i] = locations
+        return face_locations
+    
+    def _recognize(self, images_bytes, known):
+        """Recognize students of the known-face snapshot in one or more encoded images"""
+        # At most one upload is held at full resolution at a time (frames within
+        # DETECTION_MAX_SIDE are their own detection copy). Without CUDA each
+        # upload is detected and encoded before the next is decoded; with CUDA
+        # the shrunk copies are detected as a batch and each upload is decoded
+        # again for encoding.
+        face_encodings = []
+        if dlib.DLIB_USE_CUDA:
+            shrunk = [shrink_for_detection(decode_upload(image_bytes)) for image_bytes in images_bytes]
+            small_images = [small_image for small_image, _ in shrunk]
+            scales = [scale for _, scale in shrunk]
+            del shrunk
+            detected_locations = self._detect_faces(small_images)
+            del small_images
+            
+            for image_bytes, scale, face_locations in zip(images_bytes, scales, detected_locations):
+                image = decode_upload(image_bytes)
+                face_encodings.extend(face_recognition.face_encodings(
+                    image, scale_face_locations(face_locations, scale, image.shape), num_jitters=1
+                ))
+                del image
+        else:
+            for image_bytes in images_bytes:
+                image = decode_upload(image_bytes)
+                small_image, scale = shrink_for_detection(image)
+                face_locations = self._detect_faces([small_image])[0]
+                del small_image
+                # Encode from the full-resolution frame; with the faces already
+                # located this is cheap, and small back-row faces keep their pixels
+                face_encodings.extend(face_recognition.face_encodings(
+                    image, scale_face_locations(face_locations, scale, image.shape), num_jitters=1
+                ))
+                del image
+        
+        present_students = set()
         attendance_results = []
         
-        for face_encoding in face_encodings:
-            # Compare with known faces
-            matches = face_recognition.compare_faces(self.known_face_encodings, face_encoding)
-            face_distances = face_recognition.face_distance(self.known_face_encodings, face_encoding)
-            
-            if len(face_distances) > 0:
-                best_match_index = np.argmin(face_distances)
-                if matches[best_match_index]:
-                    student_id = self.known_face_ids[best_match_index]
-                    present_students.append(student_id)
-                    
-                    # Get student name
-                    conn = sqlite3.connect('attendance.db')
-                    cursor = conn.cursor()
-                    cursor.execute("SELECT name FROM students WHERE student_id = ?", (student_id,))
-                    result = cursor.fetchone()
-                    student_name = result[0] if result else "Unknown"
-                    conn.close()
-                    
-                    attendance_results.append({
-                        'student_id': student_id,
-                        'name': student_name,
-                        'status': 'Present',
-                        'confidence': float(1 - face_distances[best_match_index])
-                    })
+        if face_encodings and len(known.face_ids) > 0:
+            # Compare all detected faces with all known faces in one pass
+            probes = np.asarray(face_encodings, dtype=np.float32)
+            best_match_indices, best_distances_sq = known.match_faces(probes)
+        else:
+            best_match_indices, best_distances_sq = [], []
         
-        # Record attendance in database
-        today = date.today().isoformat()
-        conn = sqlite3.connect('attendance.db')
-        cursor = conn.cursor()
+        for best_match_index, distance_sq in zip(best_match_indices, best_distances_sq):
+            if distance_sq <= MATCH_DISTANCE_SQ:
+                student_id = known.face_ids[best_match_index]
+                if student_id in present_students:
+                    # Already seen in another image of this batch
+                    continue
+                present_students.add(student_id)
+                student_name = known.names.get(student_id, "Unknown")
+                
+                attendance_results.append({
+                    'student_id': student_id,
+                    'name': student_name,
+                    'status': 'Present',
+                    'confidence': float(1 - np.sqrt(distance_sq))
+                })
         
-        # Get all students
-        cursor.execute("SELECT student_id FROM students")
-        all_students = [row[0] for row in cursor.fetchall()]
+        return attendance_results
+    
+    def _write_attendance(self, attendance_results, known):
+        """Record today's attendance for the whole roster of the known-face snapshot"""
+        today = date.today().isoformat()
+        present_set = {result['student_id'] for result in attendance_results}
+        rows = [
+            (student_id, today, 'Present' if student_id in present_set else 'Absent')
+            for student_id in known.all_ids
+        ]
         
-        for student_id in all_students:
-            status = 'Present' if student_id in present_students else 'Absent'
-            cursor.execute(
+        with DB_LOCK, DB:
+            DB.executemany(
                 "INSERT OR REPLACE INTO attendance (student_id, date, status) VALUES (?, ?, ?)",
-                (student_id, today, status)
+                rows
             )
+    
+    def mark_attendance(self, images_bytes, cache_key=None):
+        """Mark attendance from one or more encoded images
         
-        conn.commit()
-        conn.close()
+        cache_key is the images' content_key, if the caller already computed it.
+        """
+        # Re-submitted images reuse their earlier recognition; attendance is
+        # still written so the records reflect the latest submission
+        if cache_key is None:
+            cache_key = content_key(images_bytes)
+        with self.recognition_cache_lock:
+            attendance_results = self.recognition_cache.get(cache_key)
+            if attendance_results is not None:
+                self.recognition_cache.move_to_end(cache_key)
+            # Read the snapshot and its version together so they always agree
+            known = self.known
+            known_faces_version = self.known_faces_version
         
+        if attendance_results is None:
+            attendance_results = self._recognize(images_bytes, known)
+            with self.recognition_cache_lock:
+                # Skip caching if the known faces were reloaded meanwhile
+                if known_faces_version == self.known_faces_version:
+                    self.recognition_cache[cache_key] = attendance_results
+                    if len(self.recognition_cache) > RECOGNITION_CACHE_SIZE:
+                        self.recognition_cache.popitem(last=False)
+        
+        self._write_attendance(attendance_results, known)
         return attendance_results
 
 # Initialize system
 attendance_system = AttendanceSystem()
 
+# Background recognition: a separate worker process runs dlib against its
+# resident known-face matrix while requests return immediately with a job id.
+# The worker is spawned rather than forked, so it inherits no threads, SQLite
+# handles or CUDA context; importing this module there loads its own
+# AttendanceSystem once.
+MAX_PENDING_JOBS = 32
+MAX_FINISHED_JOBS = 1000
+jobs = {}
+job_ids_by_key = {}
+jobs_lock = threading.Lock()
+
+def _new_recognition_executor():
+    return ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+
+def _recognition_job(images_bytes, cache_key):
+    """Run one queued attendance job in the worker process"""
+    # Registrations happen in the web process, so the worker's roster can be stale
+    attendance_system.reload_if_roster_changed()
+    return attendance_system.mark_attendance(images_bytes, cache_key)
+
+def _submit_recognition(images_bytes, cache_key):
+    """Queue a recognition job, replacing the worker pool if its process died"""
+    global recognition_executor
+    try:
+        return recognition_executor.submit(_recognition_job, images_bytes, cache_key)
+    except BrokenProcessPool:
+        recognition_executor = _new_recognition_executor()
+        return recognition_executor.submit(_recognition_job, images_bytes, cache_key)
+
+if multiprocessing.parent_process() is None:
+    recognition_executor = _new_recognition_executor()
+
+def _prune_jobs():
+    """Forget the oldest finished jobs beyond MAX_FINISHED_JOBS; call with jobs_lock held"""
+    finished = [job_id for job_id, job in jobs.items() if job.done()]
+    for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+        del jobs[job_id]
+    for key, job_id in list(job_ids_by_key.items()):
+        if job_id not in jobs:
+            del job_ids_by_key[key]
+
 @app.route('/api/register', methods=['POST'])
 def register_student():
     """Register a new student"""
@@ -169,25 +565,65 @@ def register_student():
     
     student_id = request.form.get('student_id')
     name = request.form.get('name')
-    image_file = request.files['image']
+    image_bytes = request.files['image'].read()
     
     if not student_id or not name:
         return jsonify({'success': False, 'message': 'Student ID and name are required'})
     
-    success, message = attendance_system.register_student(student_id, name, image_file)
+    success, message = attendance_system.register_student(student_id, name, image_bytes)
     return jsonify({'success': success, 'message': message})
 
 @app.route('/api/mark_attendance', methods=['POST'])
 def mark_attendance():
-    """Mark attendance from uploaded image"""
+    """Queue attendance marking for one or more uploaded images"""
     if 'image' not in request.files:
         return jsonify({'success': False, 'message': 'No image provided'})
     
-    image_file = request.files['image']
-    results = attendance_system.mark_attendance(image_file)
+    # Read the uploads here; only plain bytes can be handed to the worker process
+    images_bytes = [image_file.read() for image_file in request.files.getlist('image')]
+    
+    # Identical uploads share the pending job instead of being recognized twice
+    idempotency_key = content_key(images_bytes)
+    
+    with jobs_lock:
+        job_id = job_ids_by_key.get(idempotency_key)
+        if job_id is None or jobs[job_id].done():
+            # Every pending job holds its uploads in memory, so bound the queue
+            if sum(not job.done() for job in jobs.values()) >= MAX_PENDING_JOBS:
+                return jsonify({
+                    'success': False,
+                    'message': 'Too many attendance jobs queued, try again shortly'
+                }), 503
+            job_id = uuid.uuid4().hex
+            jobs[job_id] = _submit_recognition(images_bytes, idempotency_key)
+            job_ids_by_key[idempotency_key] = job_id
+            _prune_jobs()
+    
+    return jsonify({'success': True, 'job_id': job_id}), 202
+
+@app.route('/api/job/<job_id>', methods=['GET'])
+def get_job(job_id):
+    """Poll a queued attendance job"""
+    with jobs_lock:
+        job = jobs.get(job_id)
+    
+    if job is None:
+        return jsonify({'success': False, 'message': 'Unknown job'}), 404
+    if not job.done():
+        return jsonify({'success': True, 'job_id': job_id, 'status': 'pending'}), 202
+    if job.exception() is not None:
+        return jsonify({
+            'success': False,
+            'job_id': job_id,
+            'status': 'failed',
+            'message': f'Error: {str(job.exception())}'
+        })
     
+    results = job.result()
     return jsonify({
         'success': True,
+        'job_id': job_id,
+        'status': 'done',
         'results': results,
         'total_present': len(results),
         'message': f'Attendance marked for {len(results)} students'
@@ -196,18 +632,12 @@ def mark_attendance():
 @app.route('/api/attendance/<date>', methods=['GET'])
 def get_attendance(date):
     """Get attendance for a specific date"""
-    conn = sqlite3.connect('attendance.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
+    records = _read_connection().execute('''
         SELECT s.student_id, s.name, a.status, a.timestamp 
         FROM students s 
         LEFT JOIN attendance a ON s.student_id = a.student_id AND a.date = ?
         ORDER BY s.student_id
-    ''', (date,))
-    
-    records = cursor.fetchall()
-    conn.close()
+    ''', (date,)).fetchall()
     
     attendance_data = []
     for record in records:
@@ -228,32 +658,23 @@ def update_attendance():
     date = data.get('date')
     status = data.get('status')
     
-    conn = sqlite3.connect('attendance.db')
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT OR REPLACE INTO attendance (student_id, date, status) VALUES (?, ?, ?)",
-        (student_id, date, status)
-    )
-    conn.commit()
-    conn.close()
+    with DB_LOCK, DB:
+        DB.execute(
+            "INSERT OR REPLACE INTO attendance (student_id, date, status) VALUES (?, ?, ?)",
+            (student_id, date, status)
+        )
     
     return jsonify({'success': True, 'message': 'Attendance updated'})
 
 @app.route('/api/export/<date>', methods=['GET'])
 def export_attendance(date):
     """Export attendance as CSV"""
-    conn = sqlite3.connect('attendance.db')
-    cursor = conn.cursor()
-    
-    cursor.execute('''
+    records = _read_connection().execute('''
         SELECT s.student_id, s.name, a.status 
         FROM students s 
         LEFT JOIN attendance a ON s.student_id = a.student_id AND a.date = ?
         ORDER BY s.student_id
-    ''', (date,))
-    
-    records = cursor.fetchall()
-    conn.close()
+    ''', (date,)).fetchall()
     
     csv_data = "Student ID,Name,Status,Date\n"
     for record in records:
@@ -265,5 +686,4 @@ def export_attendance(date):
     }
 
 if __name__ == '__main__':
-    init_db()
     app.run(debug=True, port=5000)
\ No newline at end of file